@@ -1,8 +1,144 @@
 #!/usr/bin/env python3
 
-import os, shutil
-import argparse, yaml
-import copy, pickle
+import os, sys, shutil
+import argparse
+import contextlib, gc, itertools, json, mmap
+
+# PyYAML is only imported once YAML is actually read or written, so
+# commands answered from the JSON cache do not pay for it.  Use the
+# LibYAML bindings when they are available; fall back to the
+# pure-Python implementation otherwise.
+yaml_backend = None
+
+def YAMLBackend():
+    global yaml_backend
+    if yaml_backend is None:
+        import yaml
+        try:
+            from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+        except ImportError:
+            from yaml import SafeLoader, SafeDumper
+        yaml_backend = (yaml, SafeLoader, SafeDumper)
+    return yaml_backend
+
+# All YAML reading and writing goes through these, so the backend
+# only needs changing in one place
+def LoadYAML(stream):
+    yaml, SafeLoader, SafeDumper = YAMLBackend()
+    return yaml.load(stream, Loader=SafeLoader)
+
+def LoadAllYAML(stream):
+    yaml, SafeLoader, SafeDumper = YAMLBackend()
+    return yaml.load_all(stream, Loader=SafeLoader)
+
+def DumpYAML(data, stream, **options):
+    yaml, SafeLoader, SafeDumper = YAMLBackend()
+    yaml.dump(data, stream, Dumper=SafeDumper, default_flow_style=False, allow_unicode=True, **options)
+
+def DumpAllYAML(documents, stream, **options):
+    yaml, SafeLoader, SafeDumper = YAMLBackend()
+    yaml.dump_all(documents, stream, Dumper=SafeDumper, default_flow_style=False, allow_unicode=True, **options)
+
+# The cache is plain JSON; use orjson to read and write it when it is
+# available, falling back to the standard library otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def LoadJSON(json_file):
+    # orjson parses straight out of a memory map of the file, saving
+    # the copy into a bytes object
+    if orjson is None:
+        return json.loads(json_file.read())
+    if os.fstat(json_file.fileno()).st_size == 0:
+        return orjson.loads(b'')
+    with mmap.mmap(json_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+        return orjson.loads(view)
+
+def ReadJSON(path):
+    # Read a JSON file, or None if it is missing or can't be decoded.
+    # The cyclic garbage collector only slows down building this many
+    # small containers, none of which are garbage
+    if not os.path.exists(path):
+        return None
+    gc.disable()
+    try:
+        with open(path, 'rb') as json_file:
+            return LoadJSON(json_file)
+    except ValueError:
+        return None
+    finally:
+        gc.enable()
+
+def DumpJSON(data):
+    return orjson.dumps(data) if orjson is not None else json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+# Copy a file's contents (not its metadata).  On Linux, first try a
+# copy-on-write clone (FICLONE; btrfs, XFS) and then copy_file_range,
+# which keeps the copy in the kernel (or on the server, over NFS);
+# otherwise, or if neither works for these files, shutil.copyfile
+# uses the platform's in-kernel copy (sendfile, fcopyfile) if it can
+FICLONE = 0x40049409
+
+def CopyFile(source, destination):
+    if sys.platform.startswith('linux') and not \
+       (os.path.exists(destination) and os.path.samefile(source, destination)):
+        import fcntl
+        with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+                return
+            except OSError:
+                pass
+            # Copy until the end of the source rather than trusting its
+            # size, which can change or (in /proc, say) read as zero;
+            # fall back unless at least that much was copied
+            try:
+                size = os.fstat(source_file.fileno()).st_size
+                total = 0
+                while True:
+                    copied = os.copy_file_range(source_file.fileno(), destination_file.fileno(), 1 << 30)
+                    if copied == 0:
+                        break
+                    total += copied
+                if total > 0 and total >= size:
+                    return
+            except (AttributeError, OSError):
+                pass
+    shutil.copyfile(source, destination)
+
+# Append documents to a YAML file, starting on a new line even if the
+# file was left without a final newline (e.g. by an editor), and make
+# sure they are on disk before carrying on
+def AppendYAML(path, documents):
+    with open(path, 'a+b') as outfile:
+        if outfile.seek(0, os.SEEK_END) > 0:
+            outfile.seek(-1, os.SEEK_END)
+            if outfile.read(1) != b'\n':
+                outfile.write(b'\n')
+        DumpAllYAML(documents, outfile, explicit_start=True, encoding='utf-8')
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+# Write a file under a temporary name and move it into place once it
+# is complete, so readers never see a partly written file
+@contextlib.contextmanager
+def ReplaceFile(path, mode='w', **options):
+    temp_path = path+'.tmp'
+    try:
+        with open(temp_path, mode, **options) as temp_file:
+            yield temp_file
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# LitMan configuration file
+litman_config_path = "{}/.litman".format(os.path.expanduser("~"))
 
 # Reference types are defined as class objects.
 # Change and add properties by modifying these structures.
@@ -12,18 +148,22 @@ import copy, pickle
 # a label format for bookkeeping and referencing, and an
 # output format for printing.
 
+# Characters dropped from names when making labels
+label_strip_table = str.maketrans('', '', ' .:()/')
+
 # Base class
 class LitManReference:
-    def InitRequiredAttributes(self):
-        self.category = ""
-        self.title = ""
-        self.authors = [""]
-        self.year = -1
-        self.file = ""
-        self.tags = [""]
-        self.important = False
-        self.printed = False
-        self.read = False
+    # Fields given on the command line when adding a reference, as
+    # (name, type, nargs); bool fields are flags
+    fields = (('authors', str, '+'),
+              ('category', str, None),
+              ('file', str, None),
+              ('important', bool, None),
+              ('printed', bool, None),
+              ('read', bool, None),
+              ('tags', str, '+'),
+              ('title', str, None),
+              ('year', str, None))
 
     def Initialize(self, config):
         self.type = config.type
@@ -31,7 +171,7 @@ class LitManReference:
         self.title = config.title
         self.authors = config.authors
         self.year = config.year
-        self.file = os.path.abspath(config.file)
+        self.file = config.file
         self.tags = config.tags + [config.category.lower()]
         self.tags.sort()
         self.important = config.important
@@ -42,19 +182,18 @@ class LitManReference:
         self.references = []
         self.citations = []
 
+    @classmethod
+    def FieldSpec(cls):
+        return sorted(cls.fields)
+
     def Strip(self, attribute):
-        return attribute.replace(' ', '').replace('.', '').replace(':', '').replace('(', '').replace(')', '').replace('/', '')
+        return attribute.translate(label_strip_table)
 
 # Article reference type
 class LitManArticle(LitManReference):
-    def __init__(self):
-        self.InitRequiredAttributes()
-
-    def InitRequiredAttributes(self):
-        super().InitRequiredAttributes()
-        self.journal = ""
-        self.issue = -1
-        self.number = ""
+    fields = LitManReference.fields + (('issue', str, None),
+                                       ('journal', str, None),
+                                       ('number', str, None))
 
     def Initialize(self, config):
         super().Initialize(config)
@@ -75,14 +214,9 @@ class LitManArticle(LitManReference):
 
 # Conference reference type
 class LitManConference(LitManReference):
-    def __init__(self):
-        self.InitRequiredAttributes()
-
-    def InitRequiredAttributes(self):
-        super().InitRequiredAttributes()
-        self.conference = ""
-        self.location = ""
-        self.number = ""
+    fields = LitManReference.fields + (('conference', str, None),
+                                       ('location', str, None),
+                                       ('number', str, None))
 
     def Initialize(self, config):
         super().Initialize(config)
@@ -102,12 +236,7 @@ class LitManConference(LitManReference):
 
 # Note reference type
 class LitManNote(LitManReference):
-    def __init__(self):
-        self.InitRequiredAttributes()
-
-    def InitRequiredAttributes(self):
-        super().InitRequiredAttributes()
-        self.name = ""
+    fields = LitManReference.fields + (('name', str, None),)
 
     def Initialize(self, config):
         super().Initialize(config)
@@ -123,13 +252,8 @@ class LitManNote(LitManReference):
 
 # Thesis reference type
 class LitManThesis(LitManReference):
-    def __init__(self):
-        self.InitRequiredAttributes()
-
-    def InitRequiredAttributes(self):
-        super().InitRequiredAttributes()
-        self.university = ""
-        self.department = ""
+    fields = LitManReference.fields + (('department', str, None),
+                                       ('university', str, None))
 
     def Initialize(self, config):
         super().Initialize(config)
@@ -147,13 +271,8 @@ class LitManThesis(LitManReference):
 
 # Book reference type
 class LitManBook(LitManReference):
-    def __init__(self):
-        self.InitRequiredAttributes()
-
-    def InitRequiredAttributes(self):
-        super().InitRequiredAttributes()
-        self.publisher = ""
-        self.edition = ""
+    fields = LitManReference.fields + (('edition', str, None),
+                                       ('publisher', str, None))
 
     def Initialize(self, config):
         super().Initialize(config)
@@ -168,11 +287,46 @@ class LitManBook(LitManReference):
     def FormatSpecificInfo(book):
         return "{}, {} Edition".format(book['publisher'], book['edition'])
 
-reference_types = {"article":LitManArticle(),
-                   "conference":LitManConference(),
-                   "note":LitManNote(),
-                   "thesis":LitManThesis(),
-                   "book":LitManBook()}
+reference_types = {"article":LitManArticle,
+                   "conference":LitManConference,
+                   "note":LitManNote,
+                   "thesis":LitManThesis,
+                   "book":LitManBook}
+
+# Type specific output format for each reference type
+format_specific_info = {ref_type: reference_types[ref_type].FormatSpecificInfo
+                        for ref_type in reference_types}
+
+# Status markers shown next to a reference's label
+marker_important = " \033[7mImportant\033[0m"
+marker_printed = " \033[7mPrinted\033[0m"
+marker_to_read = " \033[7mTo Read\033[0m"
+marker_notes = " \033[7mNotes\033[0m"
+
+# Every combination of markers, indexed by a bitmask of the
+# important, printed, to-read and notes flags (in that order)
+marker_table = [(marker_important if mask & 1 else "") +
+                (marker_printed if mask & 2 else "") +
+                (marker_to_read if mask & 4 else "") +
+                (marker_notes if mask & 8 else "")
+                for mask in range(16)]
+
+# Basic and type specific information printed for each reference
+entry_template = "\033[34m{label}\033[30m:{markers}\n  \033[4m{title}\033[0m\n    \033[3m{authors}\033[0m\n    {info} ({year})"
+
+# Tags, notes and linked references (filled from the linked entry)
+# printed unless the output is compact
+tags_template = "  (\033[31m{}\033[30m)"
+note_template = "\033[2m    - {}\033[0m"
+citations_header = "  \033[32mCitations:\033[0m"
+references_header = "  \033[32mReferences:\033[0m"
+link_template = "    - {label}: {title} ({year})"
+
+# Options each batch operation must give
+batch_required = {"edit": ["ref"],
+                  "link": ["ref", "cite"],
+                  "mark": ["ref"],
+                  "note": ["ref", "note"]}
 
 class LitMan:
     def __init__(self, config):
@@ -184,175 +338,386 @@ class LitMan:
         if not os.path.exists(self.LitManDir):
             raise RuntimeError("\n\033[31mLitMan directory {} does not exist.\033[0m".format(self.LitManDir))
         self.BackupDir = config['backup']
-        if not os.path.exists(self.LitManDir):
-            raise RuntimeError("\n\033[31mLitMan directory {} does not exist.\033[0m".format(self.LitManDir))
 
-        # Set database files
-        self.LitManDB = self.LitManDir+'/litman.yaml'
-        if not os.path.exists(self.LitManDB):
-            with open(self.LitManDB, 'w'):
-                os.utime(self.LitManDB, None)
-        self.LitManFiles = self.LitManDir+'/files/'
-        if not os.path.exists(self.LitManFiles):
-            os.mkdir(self.LitManFiles)
-        self.LitManCache = self.LitManDir+'/litman.pickle'
+        # Set database files (the YAML database is created on the first add)
+        self.LitManDB = os.path.join(self.LitManDir, 'litman.yaml')
+        self.LitManFiles = os.path.join(self.LitManDir, 'files')
+        self.LitManCache = os.path.join(self.LitManDir, 'litman.json')
+        self.LitManJournal = os.path.join(self.LitManDir, 'litman.journal.yaml')
+        self.LitManSearchCache = os.path.join(self.LitManDir, 'litman.search.json')
+        self.LitManIndex = None
+        self.LitManSearchIndex = None
+        self.LitManCacheStamp = None
+        self.LitManYAMLSynced = True
+        self.LitManYAMLJournal = 0
+
+        # File directories already made during this run
+        self.LitManFileDirs = set()
 
     def Add(self, config):
+        self.AddMany(config, [config])
 
-        # Make reference object
-        new_ref = copy.deepcopy(reference_types[config.type])
-        new_ref.Initialize(config)
-
-        # Ensure this is a new entry
+    def AddBatch(self, config):
+        # Read the references from the batch file (or standard input),
+        # each a dict of the type and the fields given to add
+        if config.file == '-':
+            entries = LoadYAML(sys.stdin)
+        else:
+            with open(config.file, 'r') as batch_file:
+                entries = LoadYAML(batch_file)
+        if not entries:
+            return
+        if type(entries) != list or any(type(entry) != dict for entry in entries):
+            raise ValueError("\n\033[31mBatch file \033[34m{}\033[31m must be a list of references.\033[0m\n".format(config.file))
+
+        # Fill in the options as the add command would have parsed them
+        ref_configs = []
+        for entry in entries:
+            if entry.get('type') not in reference_types:
+                raise ValueError("\n\033[31mUnknown reference type \033[34m{}\033[31m.\033[0m\n".format(entry.get('type')))
+            ref_config = argparse.Namespace(type=entry['type'],
+                                            keep_original_file=entry.get('keep_original_file', config.keep_original_file))
+            for var, this_type, this_nargs in reference_types[entry['type']].FieldSpec():
+                if this_type == bool:
+                    setattr(ref_config, var, bool(entry.get(var, False)))
+                elif var not in entry:
+                    raise ValueError("\n\033[31mReference is missing \033[34m{}\033[31m.\033[0m\n".format(var))
+                elif this_nargs == '+':
+                    values = entry[var] if type(entry[var]) == list else [entry[var]]
+                    setattr(ref_config, var, [this_type(value) for value in values])
+                else:
+                    setattr(ref_config, var, this_type(entry[var]))
+            ref_configs.append(ref_config)
+        self.AddMany(config, ref_configs)
+
+    def AddMany(self, config, ref_configs):
+
+        # Make reference objects
+        new_refs = []
+        for ref_config in ref_configs:
+            new_ref = reference_types[ref_config.type]()
+            new_ref.Initialize(ref_config)
+            new_refs.append(new_ref)
+
+        # Ensure these are all new entries, before touching any files
         litman_db = self.LoadDB(config)
-        if litman_db is not None and new_ref.label in litman_db:
-            raise NameError("\033[31mReference \033[34m{}\033[31m already exists in database.\033[0m".format(new_ref.label))
-
-        # Copy file
-        copy_path = '{}/{}'.format(self.LitManFiles, config.category.lower())
-        if not os.path.exists(copy_path):
-            os.mkdir(copy_path)
-        extension = os.path.splitext(os.path.basename(config.file))[1]
-        copy_file = '{}/{}'.format(copy_path, new_ref.label+extension)
-        shutil.copy(config.file, copy_file)
-        new_ref.file = copy_file
-
-        # Remove original file
-        if not config.keep_original_file:
-            os.remove(config.file)
+        if litman_db is None:
+            litman_db = {}
+        labels = set()
+        for new_ref in new_refs:
+            if new_ref.label in litman_db or new_ref.label in labels:
+                raise NameError("\033[31mReference \033[34m{}\033[31m already exists in database.\033[0m".format(new_ref.label))
+            labels.add(new_ref.label)
+
+        # ...and that every file exists and is only imported once
+        sources = set()
+        for ref_config in ref_configs:
+            if not os.path.isfile(ref_config.file):
+                raise ValueError("\n\033[31mFile \033[34m{}\033[31m does not exist.\033[0m\n".format(ref_config.file))
+            source = os.path.realpath(ref_config.file)
+            if source in sources:
+                raise ValueError("\n\033[31mFile \033[34m{}\033[31m is given for more than one reference.\033[0m\n".format(ref_config.file))
+            sources.add(source)
+
+        # Work out where each file goes
+        copies = []
+        for ref_config, new_ref in zip(ref_configs, new_refs):
+            copy_path = os.path.join(self.LitManFiles, ref_config.category.lower())
+            if copy_path not in self.LitManFileDirs:
+                os.makedirs(copy_path, exist_ok=True)
+                self.LitManFileDirs.add(copy_path)
+            extension = os.path.splitext(ref_config.file)[1]
+            copy_file = os.path.join(copy_path, new_ref.label+extension)
+            copies.append((ref_config.file, copy_file))
+            new_ref.file = copy_file
+
+        # Copy files (several at once when adding a batch)
+        if len(copies) > 1:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                list(executor.map(CopyFile, *zip(*copies)))
         else:
-            new_ref.original_file = config.file
-
-        # Add to database
-        with open(self.LitManDB, 'a') as outfile:
-            yaml.dump(dict({new_ref.label: vars(new_ref)}), outfile, default_flow_style=False, allow_unicode=True)
-        self.Cache()
-
-    def Backup(self):
-        with open("{}/.litman".format(os.path.expanduser("~")), 'r') as litman_config_file:
-            litman_config = yaml.safe_load(litman_config_file)
-        if 'backup' not in litman_config:
-            raise RuntimeError("\n\033[31mLitMan backup directory not set (use \033[31;1mlitman setup --backup\033[31m to add)\033[0m.\n")
-        backup_directory = litman_config['backup']
-        if not os.path.exists(backup_directory):
-            raise RuntimeError("\n\033[31mLitMan backup directory {} does not exist.\033[0m\n".format(backup_directory))
-        copy_path = backup_directory+'/'+os.path.basename(self.LitManDB)+'.backup'
-        shutil.copy(self.LitManDB, copy_path)
-
-    def Cache(self):
-        with open(self.LitManDB, 'r') as litman_db_file:
-            litman_db = yaml.safe_load(litman_db_file)
-            with open(self.LitManCache, 'wb') as litman_pickle_file:
-                pickle.dump(litman_db, litman_pickle_file, protocol=pickle.HIGHEST_PROTOCOL)
+            for source, destination in copies:
+                CopyFile(source, destination)
 
-    def Edit(self, config):
-        # Get the database
+        # Remove original files, once everything is copied
+        for ref_config, new_ref in zip(ref_configs, new_refs):
+            if not ref_config.keep_original_file:
+                os.remove(ref_config.file)
+            else:
+                new_ref.original_file = ref_config.file
+
+        # Add to database in one write (the whole database is saved
+        # instead if the YAML file is behind the cache, or has changes
+        # waiting in the journal)
+        for new_ref in new_refs:
+            litman_db[new_ref.label] = vars(new_ref)
+        if config.no_yaml_sync or not self.LitManYAMLSynced or os.path.exists(self.LitManJournal):
+            self.Resave(litman_db, not config.no_yaml_sync)
+            return
+        AppendYAML(self.LitManDB, [{new_ref.label: vars(new_ref)} for new_ref in new_refs])
+
+        # Update the cache from memory rather than re-parsing the YAML
+        self.Cache(litman_db)
+
+    def ApplyBatch(self, config, ops):
+        # Apply a list of edit, link, mark and note operations, each
+        # a dict of the command and its options, and save once (each
+        # operation returns the labels of the entries it changed)
         litman_db = self.LoadDB(config)
-
+        changed = set()
+        apply = {"edit": self.ApplyEdit,
+                 "link": self.ApplyLink,
+                 "mark": self.ApplyMark,
+                 "note": self.ApplyNote}
+        for op in ops:
+            if op.get('command') not in apply:
+                raise ValueError("\n\033[31mUnknown batch command \033[34m{}\033[31m.\033[0m\n".format(op.get('command')))
+            changed.update(apply[op['command']](litman_db, op))
+        self.Resave(litman_db, not config.no_yaml_sync, changed)
+
+    def ApplyEdit(self, litman_db, op):
         # Find the requested reference
-        if config.ref not in litman_db:
-            raise ValueError("\n\033[31mRequested reference \033[34m{}\033[31m not in database.\033[0m\n".format(config.ref))
-        ref = litman_db[config.ref]
+        if op['ref'] not in litman_db:
+            raise ValueError("\n\033[31mRequested reference \033[34m{}\033[31m not in database.\033[0m\n".format(op['ref']))
+        ref = litman_db[op['ref']]
+        changed = [op['ref']]
 
         # Make edits
-        if config.add_tag is not None:
-            ref["tags"].append(config.add_tag)
+        if op.get('add_tag') is not None:
+            ref["tags"].append(op['add_tag'])
             ref["tags"].sort()
 
-        if config.rm_tag is not None:
-            Confirm("Remove tag {} from {}?".format(config.rm_tag, config.ref))
-            ref["tags"].remove(config.rm_tag)
+        if op.get('rm_tag') is not None:
+            Confirm("Remove tag {} from {}?".format(op['rm_tag'], op['ref']))
+            ref["tags"].remove(op['rm_tag'])
 
-        if config.rm_note is not None:
-            Confirm("Remove note {} from {}?".format(config.rm_note, config.ref))
-            del ref["notes"][config.rm_note]
+        if op.get('rm_note') is not None:
+            Confirm("Remove note {} from {}?".format(op['rm_note'], op['ref']))
+            del ref["notes"][op['rm_note']]
 
-        if config.rm_ref is not None:
-            cited = litman_db[ref["references"][config.rm_ref]]
+        if op.get('rm_ref') is not None:
+            cited = litman_db[ref["references"][op['rm_ref']]]
             Confirm("Remove reference {} from {} (and citation {} from {})?"
-                    .format(cited['label'], config.ref, config.ref, cited['label']))
+                    .format(cited['label'], op['ref'], op['ref'], cited['label']))
             ref["references"].remove(cited['label'])
-            cited["citations"].remove(config.ref)
+            cited["citations"].remove(op['ref'])
+            changed.append(cited['label'])
 
-        if config.rm_cite is not None:
-            refed = litman_db[ref["citations"][config.rm_cite]]
+        if op.get('rm_cite') is not None:
+            refed = litman_db[ref["citations"][op['rm_cite']]]
             Confirm("Remove citation {} from {} (and reference {} from {})?"
-                    .format(refed['label'], config.ref, config.ref, refed['label']))
+                    .format(refed['label'], op['ref'], op['ref'], refed['label']))
             ref['citations'].remove(refed['label'])
-            refed['references'].remove(config.ref)
+            refed['references'].remove(op['ref'])
+            changed.append(refed['label'])
 
-        self.Resave(litman_db)
-
-    def Link(self, config):
-        # Get the database
-        litman_db = self.LoadDB(config)
+        return changed
 
+    def ApplyLink(self, litman_db, op):
         # Find the requested reference
-        if config.ref not in litman_db:
-            raise ValueError("\n\033[31mRequested reference \033[34m{}\033[31m not in database.\033[0m\n".format(config.ref))
-        ref = litman_db[config.ref]
+        if op['ref'] not in litman_db:
+            raise ValueError("\n\033[31mRequested reference \033[34m{}\033[31m not in database.\033[0m\n".format(op['ref']))
+        ref = litman_db[op['ref']]
 
         # Find the citated reference
-        if config.cite not in litman_db:
-            raise ValueError("\n\033[31mRequested reference \033[34m{}\033[31m not in database.\033[0m\n".format(config.cite))
-        cite = litman_db[config.cite]
-
-        # Link!
-        ref["references"].append(config.cite)
-        cite["citations"].append(config.ref)
-        
-        self.Resave(litman_db)
+        if op['cite'] not in litman_db:
+            raise ValueError("\n\033[31mRequested reference \033[34m{}\033[31m not in database.\033[0m\n".format(op['cite']))
+        cite = litman_db[op['cite']]
 
-    def List(self, config):
-        litman_db = self.LoadDB(config)
-        entries = self.Winnow(litman_db, config)
-        if config.clipboard and len(entries):
-            os.system("echo {} | tr -d '\n' | pbcopy".format(entries[0]['label'].strip()))
-        self.PrintReferences(litman_db, entries, config)
+        # Link! (unless they already are)
+        if op['cite'] not in ref["references"]:
+            ref["references"].append(op['cite'])
+        if op['ref'] not in cite["citations"]:
+            cite["citations"].append(op['ref'])
 
-    def LoadDB(self, config):
-        if config.no_cache or not os.path.exists(self.LitManCache):
-            with open(self.LitManDB, 'r') as litman_db_file:
-                litman_db = yaml.safe_load(litman_db_file)
-        else:
-            with open(self.LitManCache, 'rb') as litman_pickle_file:
-                litman_db = pickle.load(litman_pickle_file)
-        return litman_db
+        return [op['ref'], op['cite']]
 
-    def Mark(self, config):
+    def ApplyMark(self, litman_db, op):
         # Find the requested reference
-        litman_db = self.LoadDB(config)
-        if config.ref not in litman_db:
-            raise ValueError("\n\033[31mRequested reference \033[34m{}\033[31m not in database.\033[0m\n".format(config.ref))
-        ref = litman_db[config.ref]
+        if op['ref'] not in litman_db:
+            raise ValueError("\n\033[31mRequested reference \033[34m{}\033[31m not in database.\033[0m\n".format(op['ref']))
+        ref = litman_db[op['ref']]
 
         # Mark with requested tag
-        if config.important is not None and config.important:
+        if op.get('important'):
             ref["important"] = True
-        if config.printed is not None and config.printed:
+        if op.get('printed'):
             ref["printed"] = True
-        if config.to_read is not None and config.to_read:
+        if op.get('to_read'):
             ref["read"] = False
-        if config.read is not None and config.read:
+        if op.get('read'):
             ref["read"] = True
 
-        self.Resave(litman_db)
+        return [op['ref']]
 
-    def Note(self, config):
+    def ApplyNote(self, litman_db, op):
         # Find the requested reference
-        litman_db = self.LoadDB(config)
-        if config.ref not in litman_db:
-            raise ValueError("\n\033[31mRequested reference \033[34m{}\033[31m not in database.\033[0m\n".format(config.ref))
-        ref = litman_db[config.ref]
+        if op['ref'] not in litman_db:
+            raise ValueError("\n\033[31mRequested reference \033[34m{}\033[31m not in database.\033[0m\n".format(op['ref']))
+        ref = litman_db[op['ref']]
 
         # Add notes
-        for note in config.note:
+        notes = op['note'] if type(op['note']) == list else [op['note']]
+        for note in notes:
             ref['notes'].append(note)
 
         # Mark as read
         ref['read'] = True
 
-        self.Resave(litman_db)
+        return [op['ref']]
+
+    def Backup(self):
+        if not os.path.exists(self.BackupDir):
+            raise RuntimeError("\n\033[31mLitMan backup directory {} does not exist.\033[0m\n".format(self.BackupDir))
+        if not os.path.exists(self.LitManDB):
+            return
+        copy_path = os.path.join(self.BackupDir, os.path.basename(self.LitManDB)+'.backup')
+        CopyFile(self.LitManDB, copy_path)
+
+        # Keep the journal's backup in step with the database's
+        journal_copy_path = os.path.join(self.BackupDir, os.path.basename(self.LitManJournal)+'.backup')
+        if os.path.exists(self.LitManJournal):
+            CopyFile(self.LitManJournal, journal_copy_path)
+        elif os.path.exists(journal_copy_path):
+            os.remove(journal_copy_path)
+
+    def Batch(self, config):
+        # Read the operations from the batch file (or standard input)
+        if config.file == '-':
+            ops = LoadYAML(sys.stdin)
+        else:
+            with open(config.file, 'r') as batch_file:
+                ops = LoadYAML(batch_file)
+        if not ops:
+            return
+
+        # Check the operations are complete before applying any
+        if type(ops) != list or any(type(op) != dict for op in ops):
+            raise ValueError("\n\033[31mBatch file \033[34m{}\033[31m must be a list of operations.\033[0m\n".format(config.file))
+        for op in ops:
+            if op.get('command') not in batch_required:
+                raise ValueError("\n\033[31mUnknown batch command \033[34m{}\033[31m.\033[0m\n".format(op.get('command')))
+            for key in batch_required[op['command']]:
+                if op.get(key) is None:
+                    raise ValueError("\n\033[31mBatch \033[34m{}\033[31m operation is missing \033[34m{}\033[31m.\033[0m\n".format(op['command'], key))
+
+            # Removals are confirmed on standard input, so can't be
+            # read from it too
+            if config.file == '-' and op['command'] == 'edit' and \
+               any(op.get(key) is not None for key in ('rm_tag', 'rm_note', 'rm_ref', 'rm_cite')):
+                raise ValueError("\n\033[31mBatch edits removing tags, notes or links need confirming, so can't be read from standard input; give them in a file.\033[0m\n")
+        self.ApplyBatch(config, ops)
+
+    def Cache(self, litman_db, yaml_synced=True):
+        # Note whether the YAML file has been left behind by changes
+        # saved only to the cache.  A new stamp marks any search index
+        # written for the previous cache as stale
+        self.LitManIndex = self.Index(litman_db)
+        self.LitManSearchIndex = None
+        self.LitManYAMLSynced = yaml_synced
+        self.LitManCacheStamp = os.urandom(8).hex()
+        litman_cache = {'db': litman_db, 'index': self.LitManIndex,
+                        'stamp': self.LitManCacheStamp,
+                        'yaml_stat': self.YAMLStat(),
+                        'yaml_synced': yaml_synced, 'yaml_journal': self.LitManYAMLJournal}
+        with ReplaceFile(self.LitManCache, 'wb') as litman_cache_file:
+            litman_cache_file.write(DumpJSON(litman_cache))
+
+    def CacheIsCurrent(self, litman_cache):
+        # The cache records the size and modification time of the YAML
+        # database as it was when the cache was written, so it is
+        # current unless the database has been changed (e.g. edited by
+        # hand, or restored from a backup) since
+        return litman_cache.get('yaml_stat') == self.YAMLStat()
+
+    def Candidates(self, term):
+        # Labels of entries which could match the (lowercase) search
+        # term, or None if the index can't narrow the search down
+        if self.LitManSearchIndex is None or len(term) < 3:
+            return None
+        trigrams = self.LitManSearchIndex['trigrams']
+        postings = [trigrams.get(term[i:i+3], ()) for i in range(len(term)-2)]
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return candidates.union(self.LitManIndex['tags'].get(term, ()))
+
+    def Edit(self, config):
+        self.ApplyBatch(config, [vars(config)])
+
+    def Index(self, litman_db):
+        # Map every (lowercased) tag, every author and every category
+        # to the labels of the entries with it
+        index = {'tags': {}, 'authors': {}, 'categories': {}}
+        if litman_db is None:
+            return index
+        for label, entry in litman_db.items():
+            for tag in set(t.lower() for t in entry['tags']):
+                index['tags'].setdefault(tag, []).append(label)
+            for author in set(entry['authors']):
+                index['authors'].setdefault(author, []).append(label)
+            index['categories'].setdefault(entry['category'], []).append(label)
+        return index
+
+    def Link(self, config):
+        self.ApplyBatch(config, [vars(config)])
+
+    def List(self, config):
+        litman_db = self.LoadDB(config)
+        entries = self.Winnow(litman_db, config)
+        if config.clipboard and len(entries):
+            import subprocess
+            subprocess.run(["pbcopy"], input=entries[0]['label'].strip().encode(), check=False)
+        self.PrintReferences(litman_db, entries, config)
+
+    def LoadDB(self, config, prefer_cache=False):
+        # Use the cache unless asked not to, or unless it is out of
+        # date, in which case it is rebuilt from the YAML (sync uses
+        # it regardless if it holds changes not yet written to the
+        # YAML).  Such a cache is never bypassed, since they would be
+        # lost
+        litman_cache = self.ReadCache()
+        if litman_cache is not None:
+            unsynced = not litman_cache.get('yaml_synced', True)
+            if (prefer_cache and unsynced) or (not config.no_cache and self.CacheIsCurrent(litman_cache)):
+                self.LitManIndex = litman_cache['index']
+                self.LitManCacheStamp = litman_cache['stamp']
+                self.LitManYAMLSynced = litman_cache.get('yaml_synced', True)
+                self.LitManYAMLJournal = litman_cache.get('yaml_journal', 0)
+                return litman_cache['db']
+            if unsynced:
+                raise RuntimeError("\n\033[31mThe cache holds changes not yet written to the YAML database; use \033[1mlitman sync\033[31m to write them (overwriting any changes made to the YAML file since) before reading it.\033[0m\n")
+        litman_db = self.ParseDB()
+        if not config.no_cache:
+            self.Cache(litman_db)
+        return litman_db
+
+    def LoadSearchIndex(self, litman_db):
+        # The search index is much larger than the rest of the cache,
+        # so it is kept in a file of its own, read only when searching,
+        # and rebuilt (on the first search after each change) if it
+        # wasn't written for this cache
+        if self.LitManSearchIndex is not None:
+            return
+        if self.LitManCacheStamp is not None:
+            search_cache = ReadJSON(self.LitManSearchCache)
+            if isinstance(search_cache, dict) and search_cache.get('stamp') == self.LitManCacheStamp:
+                self.LitManSearchIndex = search_cache['index']
+                return
+        self.LitManSearchIndex = self.SearchIndex(litman_db)
+        if self.LitManCacheStamp is not None:
+            with ReplaceFile(self.LitManSearchCache, 'wb') as search_cache_file:
+                search_cache_file.write(DumpJSON({'stamp': self.LitManCacheStamp, 'index': self.LitManSearchIndex}))
+
+    def Mark(self, config):
+        self.ApplyBatch(config, [vars(config)])
+
+    def Match(self, entry, term):
+        # Check a (lowercase) search term against the entry's indexed fields
+        fields = self.LitManSearchIndex['fields'][entry['label']]
+        return term in fields['text'] or term in fields['tags']
+
+    def Note(self, config):
+        self.ApplyBatch(config, [vars(config)])
 
     def Open(self, config):
         # Get the requested entries
@@ -362,10 +727,66 @@ class LitMan:
             print("\033[5;1m\nNo entries found!\n\033[0m")
             exit()
         if config.all:
-            file_list = " ".join([e['file'] for e in entries])
+            file_list = [e['file'] for e in entries]
         else:
-            file_list = entries[0]['file']
-        os.system("open {}".format(file_list))
+            file_list = [entries[0]['file']]
+        import subprocess
+        subprocess.run(["open", *file_list], check=False)
+
+    def ParseDB(self):
+        # Entries are stored as separate YAML documents (older
+        # databases are a single document), in the database and then
+        # the journal of later changes, so build the database up one
+        # document at a time; later documents replace earlier versions
+        # of an entry, and an empty entry removes it
+        litman_db = {}
+        written = 0
+        gc.disable()
+        try:
+            contents = b''
+            if os.path.exists(self.LitManDB):
+                with open(self.LitManDB, 'rb') as litman_db_file:
+                    contents = litman_db_file.read()
+            for document in LoadAllYAML(contents):
+                if document is None:
+                    continue
+                for label, entry in document.items():
+                    if entry is None:
+                        litman_db.pop(label, None)
+                    else:
+                        litman_db[label] = entry
+                written += len(document)
+
+            # The journal starts with the SHA-1 of the database it
+            # follows.  If the database has changed since (by hand, or
+            # in a rewrite interrupted before the journal was removed),
+            # the journal is only dropped if it has nothing to add
+            if os.path.exists(self.LitManJournal):
+                import hashlib
+                with open(self.LitManJournal, 'rb') as journal_file:
+                    journal = journal_file.read()
+                journaled = {}
+                for document in LoadAllYAML(journal):
+                    if document is None:
+                        continue
+                    journaled.update(document)
+                    written += len(document)
+                if journal.partition(b'\n')[0].split()[-1:] == [hashlib.sha1(contents).hexdigest().encode()]:
+                    for label, entry in journaled.items():
+                        if entry is None:
+                            litman_db.pop(label, None)
+                        else:
+                            litman_db[label] = entry
+                elif all(litman_db.get(label) == entry for label, entry in journaled.items()):
+                    os.remove(self.LitManJournal)
+                    written = len(litman_db)
+                else:
+                    raise RuntimeError("\n\033[31mThe YAML database \033[34m{}\033[31m has changed since the changes in \033[34m{}\033[31m were made; copy any of those still wanted into the database, and remove the journal, before reading it.\033[0m\n".format(self.LitManDB, self.LitManJournal))
+        finally:
+            gc.enable()
+        self.LitManYAMLJournal = written-len(litman_db)
+        self.LitManYAMLSynced = True
+        return litman_db
 
     def Print(self, config):
         # Get the requested entry
@@ -375,57 +796,71 @@ class LitMan:
         ref = litman_db[config.ref]
 
         # Issue print command
-        os.system("lp -d {} -o media={} -o InputSlot={} {} {} {}"
-                  .format(config.printer, config.page_size, config.printer_slot,
-                          " " if config.single_sided else "-o sides=two-sided-long-edge",
-                          config.print_options, ref['file']))
+        import shlex, subprocess
+        print_command = ["lp", "-d", config.printer,
+                         "-o", "media={}".format(config.page_size),
+                         "-o", "InputSlot={}".format(config.printer_slot)]
+        if not config.single_sided:
+            print_command += ["-o", "sides=two-sided-long-edge"]
+        print_command += shlex.split(config.print_options) + [ref['file']]
+        subprocess.run(print_command, check=False)
 
         # Mark as printed
         ref['printed'] = True
 
-        self.Resave(litman_db)
+        self.Resave(litman_db, not config.no_yaml_sync, [config.ref])
 
     def PrintReferences(self, litman_db, entries, config):
+        # Collect the output lines and write them all at once
+        lines = []
+
         # This flashes because I got carried away
         # with the ANSI formatting
         if len(entries):
-            print("\033[1;5m\nMatching entries:\033[0m\n")
+            lines.append("\033[1;5m\nMatching entries:\033[0m\n")
         else:
-            print("\033[5;1m\nNo entries found!\n\033[0m")
+            lines.append("\033[5;1m\nNo entries found!\n\033[0m")
 
         # Print each selected entry
         for entry in entries:
 
-            # Basic information
-            print("{}:{}{}{}{}\n  {}\n    {}"
-                  .format('\033[34m{}\033[30m'.format(entry['label']),
-                          " \033[7mImportant\033[0m" if entry["important"] else "",
-                          " \033[7mPrinted\033[0m" if entry["printed"] else "",
-                          " \033[7mTo Read\033[0m" if not entry["read"] else "",
-                          " \033[7mNotes\033[0m" if entry["notes"] else "",
-                          '\033[4m{}\033[0m'.format(entry['title']),
-                          '\033[3m{}\033[0m'.format(', '.join(entry['authors']))))
-
-            # Type specific information
-            print("    {} ({})".format(reference_types[entry['type']].FormatSpecificInfo(entry),
-                                       entry['year']))
+            # Basic and type specific information
+            markers = marker_table[bool(entry["important"]) |
+                                   bool(entry["printed"]) << 1 |
+                                   (not entry["read"]) << 2 |
+                                   bool(entry["notes"]) << 3]
+            lines.append(entry_template.format(label=entry['label'],
+                                               markers=markers,
+                                               title=entry['title'],
+                                               authors=', '.join(entry['authors']),
+                                               info=format_specific_info[entry['type']](entry),
+                                               year=entry['year']))
 
             # Tags, notes and links
             if not config.compact:
-                print("  (\033[31m{}\033[30m)".format(' '.join(entry['tags'])))
+                lines.append(tags_template.format(' '.join(entry['tags'])))
                 for note in entry['notes']:
-                    print("\033[2m    - {}\033[0m".format(note))
+                    lines.append(note_template.format(note))
                 if len(entry['citations']) or len(entry['references']):
-                    print("  \033[32mCitations:\033[0m")
+                    lines.append(citations_header)
                     for citation in entry['citations']:
-                        cite = litman_db[citation]
-                        print("    - {}: {} ({})".format(cite['label'], cite['title'], cite['year']))
-                    print("  \033[32mReferences:\033[0m")
+                        lines.append(link_template.format_map(litman_db[citation]))
+                    lines.append(references_header)
                     for reference in entry['references']:
-                        ref = litman_db[reference]
-                        print("    - {}: {} ({})".format(ref['label'], ref['title'], ref['year']))
+                        lines.append(link_template.format_map(litman_db[reference]))
+
+            lines.append("")
+
+        sys.stdout.write("\n".join(lines)+"\n")
 
-            print()
+    def ReadCache(self):
+        # An empty, corrupt or older cache is stale, and rebuilt from
+        # the YAML database
+        litman_cache = ReadJSON(self.LitManCache)
+        if not isinstance(litman_cache, dict) or \
+           any(key not in litman_cache for key in ('db', 'index', 'stamp')):
+            return None
+        return litman_cache
 
     def Remove(self, config):
         Confirm("Remove reference {}?".format(config.ref))
@@ -437,27 +872,61 @@ class LitMan:
         if config.delete_file:
             os.remove(litman_db[config.ref]['file'])
         else:
-            archive_path = '{}/{}'.format(self.LitManFiles, 'archive')
-            if not os.path.exists(archive_path):
-                os.mkdir(archive_path)
+            archive_path = os.path.join(self.LitManFiles, 'archive')
+            os.makedirs(archive_path, exist_ok=True)
             shutil.move(litman_db[config.ref]['file'],
                         os.path.join(archive_path, os.path.basename(litman_db[config.ref]['file'])))
 
         # Delete from database
         del litman_db[config.ref]
-        self.Resave(litman_db)
-
-    def Resave(self, litman_db):
-        if len(litman_db):
-            with open(self.LitManDB, 'w') as outfile:
-                yaml.dump(litman_db, outfile, default_flow_style=False, allow_unicode=True)
+        self.Resave(litman_db, not config.no_yaml_sync, [config.ref])
+
+    def Resave(self, litman_db, yaml_sync=True, changed=None):
+        # Only update the cache until the next sync if asked to
+        litman_db = dict(sorted(litman_db.items()))
+        if not yaml_sync:
+            self.Cache(litman_db, yaml_synced=False)
+            return
+
+        # When only a few entries changed, append their new versions
+        # (or an empty entry for removed ones) to the journal, which
+        # starts by recording the SHA-1 of the database it follows;
+        # once superseded documents outnumber the entries, rewrite the
+        # YAML database with each entry as its own document, in label
+        # order, and start a new journal
+        if changed is not None and self.LitManYAMLSynced and \
+           self.LitManYAMLJournal+len(changed) <= len(litman_db):
+            if not os.path.exists(self.LitManJournal):
+                with ReplaceFile(self.LitManJournal) as outfile:
+                    outfile.write("# Changes since litman.yaml had SHA-1 {}\n".format(self.YAMLDigest()))
+            AppendYAML(self.LitManJournal, [{label: litman_db.get(label)} for label in sorted(changed)])
+            self.LitManYAMLJournal += len(changed)+sum(label not in litman_db for label in changed)
         else:
-            os.remove(self.LitManDB)
-            with open(self.LitManDB, 'w'):
-                os.utime(self.LitManDB, None)            
-        self.Cache()
+            with ReplaceFile(self.LitManDB) as outfile:
+                DumpAllYAML([{label: entry} for label, entry in litman_db.items()], outfile, explicit_start=True)
+            if os.path.exists(self.LitManJournal):
+                os.remove(self.LitManJournal)
+            self.LitManYAMLJournal = 0
+        self.Cache(litman_db)
         self.Backup()
 
+    def SearchIndex(self, litman_db):
+        # Keep the lowercased searchable text of each entry (title,
+        # authors, journal and year, NUL-separated so terms can't match
+        # across fields) and tags, and map every character trigram in
+        # the text to the labels of the entries containing it
+        index = {'fields': {}, 'trigrams': {}}
+        for label, entry in litman_db.items():
+            text = '\0'.join([entry['title'],
+                              ' '.join(entry['authors']),
+                              entry['journal'] if 'journal' in entry else '',
+                              str(entry['year'])]).lower()
+            index['fields'][label] = {'text': text,
+                                      'tags': sorted(set(t.lower() for t in entry['tags']))}
+            for trigram in set(text[i:i+3] for i in range(len(text)-2)):
+                index['trigrams'].setdefault(trigram, []).append(label)
+        return index
+
     def Search(self, config):
         litman_db = self.LoadDB(config)
         entries = self.Winnow(litman_db, config)
@@ -466,28 +935,25 @@ class LitMan:
     def Summary(self, config):
         # Load the database
         litman_db = self.LoadDB(config)
-        categories = []
-        tags = []
-        for entry in litman_db:
-            if litman_db[entry]['category'] not in categories:
-                categories.append(litman_db[entry]['category'])
-            for tag in litman_db[entry]['tags']:
-                if tag not in tags:
-                    tags.append(tag)
-        categories.sort()
-        tags.sort()
-        print("\033[1;5m\nSummary:\033[0m\n")
-        print("\033[1m{} references\033[0m\n".format(len(litman_db)))
-        print("\033[34m{} categories:\t\t\033[31m{} tags:\033[0m"
-              .format(len(categories), len(tags)))
-        for item in range(max(len(categories), len(tags))):
-            if item < len(categories) and item < len(tags):
-                print("\033[34m - {:20}\033[31m  - {:20}\033[0m".format(categories[item], tags[item]))
-            elif item < len(categories):
-                print("\033[34m - {:20}\033[0m".format(categories[item]))
-            elif item < len(tags):
-                print("\033[31m   {:20}  - {:20}\033[0m".format(' ', tags[item]))
-        print()
+        categories = sorted({entry['category'] for entry in litman_db.values()})
+        tags = sorted({tag for entry in litman_db.values() for tag in entry['tags']})
+        lines = ["\033[1;5m\nSummary:\033[0m\n",
+                 "\033[1m{} references\033[0m\n".format(len(litman_db)),
+                 "\033[34m{} categories:\t\t\033[31m{} tags:\033[0m".format(len(categories), len(tags))]
+        for category, tag in itertools.zip_longest(categories, tags):
+            if category is not None and tag is not None:
+                lines.append("\033[34m - {:20}\033[31m  - {:20}\033[0m".format(category, tag))
+            elif category is not None:
+                lines.append("\033[34m - {:20}\033[0m".format(category))
+            else:
+                lines.append("\033[31m   {:20}  - {:20}\033[0m".format(' ', tag))
+        sys.stdout.write("\n".join(lines)+"\n\n")
+
+    def Sync(self, config):
+        # Write the YAML database out from the cache, if it holds
+        # changes not yet written there (otherwise the YAML file, with
+        # any changes made to it by hand, is reread as usual)
+        self.Resave(self.LoadDB(config, prefer_cache=True))
 
     def Winnow(self, litman_db, config):
         if litman_db is None:
@@ -504,53 +970,78 @@ class LitMan:
                     raise ValueError("\n\033[31mRequested entry \033[34m{}\033[31m not in database.\033[0m\n".format(ref))
                 entries.append(litman_db[ref])
 
-        # Search
-        keywords = config.search if "search" in config and config.search is not None else None
-        keywords = config.keyword if "keyword" in config and config.keyword is not None else None
-        if keywords is not None:
-            remove = []
-            for i_entry,entry in enumerate(entries):
-                for term in keywords:
-                    if term.lower() in entry['title'].lower() or \
-                       term.lower() in [t.lower() for t in entry['tags']] or \
-                       term.lower() in ' '.join([a.lower() for a in entry['authors']]) or \
-                       ('journal' in entry and term.lower() in entry['journal'].lower()) or \
-                       term in str(entry['year']):
-                        pass
-                    else:
-                        remove.append(i_entry)
-            entries = [e for i,e in enumerate(entries) if i not in remove]
-
-        # Authors
-        if 'authors' in config and config.authors is not None:
-            remove = []
-            for i_entry,entry in enumerate(entries):
-                for author in config.authors:
-                    if author not in entry['authors']:
-                        remove.append(i_entry)
-            entries = [e for i,e in enumerate(entries) if i not in remove]
-
-        # Markers
-        if 'important' in config and config.important:
-            keep = []
-            for i_entry,entry in enumerate(entries):
-                if entry['important']:
-                    keep.append(i_entry)
-            entries = [e for i,e in enumerate(entries) if i in keep]
-        if 'to_read' in config and config.to_read:
-            keep = []
-            for i_entry,entry in enumerate(entries):
-                if not entry['read']:
-                    keep.append(i_entry)
-            entries = [e for i,e in enumerate(entries) if i in keep]
-        if 'read' in config and config.read:
-            keep = []
-            for i_entry,entry in enumerate(entries):
-                if entry['read']:
-                    keep.append(i_entry)
-            entries = [e for i,e in enumerate(entries) if i in keep]
-
-        return entries
+        # Search terms, authors and markers
+        if "search" in config and config.search is not None:
+            keywords = config.search
+        elif "keyword" in config and config.keyword is not None:
+            keywords = config.keyword
+        else:
+            keywords = None
+        terms = [term.lower() for term in keywords] if keywords is not None else []
+        authors = config.authors if 'authors' in config else None
+        categories = config.category if 'category' in config else None
+        important = 'important' in config and config.important
+        to_read = 'to_read' in config and config.to_read
+        read = 'read' in config and config.read
+
+        # Narrow down to the entries the indices can't rule out
+        if terms or authors is not None or categories is not None:
+            if self.LitManIndex is None:
+                self.LitManIndex = self.Index(litman_db)
+        if terms:
+            self.LoadSearchIndex(litman_db)
+        labels = None
+        for term in terms:
+            candidates = self.Candidates(term)
+            if candidates is not None:
+                labels = candidates if labels is None else labels & candidates
+                if not labels:
+                    return []
+        if authors is not None:
+            author_index = self.LitManIndex['authors']
+            for author in authors:
+                postings = author_index.get(author, ())
+                labels = set(postings) if labels is None else labels.intersection(postings)
+                if not labels:
+                    return []
+        if categories is not None:
+            category_index = self.LitManIndex['categories']
+            in_categories = set()
+            for category in categories:
+                in_categories.update(category_index.get(category, ()))
+            labels = in_categories if labels is None else labels & in_categories
+            if not labels:
+                return []
+
+        # Apply every filter in a single pass
+        if labels is None and not (important or to_read or read or terms):
+            return entries
+        return [e for e in entries
+                if (labels is None or e['label'] in labels) and
+                   (not important or e['important']) and
+                   (not to_read or not e['read']) and
+                   (not read or e['read']) and
+                   all(self.Match(e, term) for term in terms)]
+
+    def YAMLDigest(self):
+        # SHA-1 of the YAML database, as the journal records it
+        import hashlib
+        if not os.path.exists(self.LitManDB):
+            return hashlib.sha1(b'').hexdigest()
+        with open(self.LitManDB, 'rb') as litman_db_file:
+            return hashlib.sha1(litman_db_file.read()).hexdigest()
+
+    def YAMLStat(self):
+        # Modification time and size of the YAML database and of its
+        # journal (None for either that doesn't exist)
+        stamp = []
+        for path in (self.LitManDB, self.LitManJournal):
+            try:
+                stat = os.stat(path)
+                stamp.append([stat.st_mtime_ns, stat.st_size])
+            except FileNotFoundError:
+                stamp.append(None)
+        return stamp
 
 def Confirm(prompt):
     choice = None
@@ -566,188 +1057,247 @@ def Confirm(prompt):
 
 def ParseArguments():
 
+    # Only the arguments of the command being run are set up (all of
+    # them when no command is given, for the full help)
+    command = next((arg for arg in sys.argv[1:] if not arg.startswith('-')), None)
+
     # Set up parser
     parser = argparse.ArgumentParser(prog="litman",
                                      description="Literature Manager: Managing literature for the lit man.")
-    parser.add_argument("--no_cache", action='store_true',
-                        help="Force load from the YAML file rather than the cache.")
+    parser.add_argument("--no_cache", "--force_yaml", action='store_true',
+                        help="Force load from the YAML file rather than the cache (which is otherwise only bypassed when the YAML database's size or modification time no longer match those recorded in the cache).")
+    parser.add_argument("--no_yaml_sync", action='store_true',
+                        help="Save changes to the cache only, leaving the YAML file to be written by \"litman sync\" (sync before editing it by hand).")
     subparser = parser.add_subparsers(title="litman command", dest="command")
     subparser.required = True
 
     # Setup
     setup_parser = subparser.add_parser("setup", help="Set up LitMan.")
-    setup_parser.add_argument("--litman_dir", required=True,
-                              help="Base directory for LitMan to use for its organization.")
-    setup_parser.add_argument("--backup_dir", required=True,
-                              help="Backup directory for LitMan to store a copy of the database.")
+    if command in (None, "setup"):
+        setup_parser.add_argument("--litman_dir", required=True,
+                                  help="Base directory for LitMan to use for its organization.")
+        setup_parser.add_argument("--backup_dir", required=True,
+                                  help="Backup directory for LitMan to store a copy of the database.")
 
     # Config
     config_parser = subparser.add_parser("config", help="Configuration options.")
-    config_parser.add_argument("--litman_dir", help="Base directory for LitMan to use for its organization.")
-    config_parser.add_argument("--backup_dir", help="Backup directory for LitMan to store a copy of the database.")
+    if command in (None, "config"):
+        config_parser.add_argument("--litman_dir", help="Base directory for LitMan to use for its organization.")
+        config_parser.add_argument("--backup_dir", help="Backup directory for LitMan to store a copy of the database.")
 
     # Cache
-    cache_parser = subparser.add_parser("cache", help="Rebuild the LitMan cache.")
+    cache_parser = subparser.add_parser("cache", help="Rebuild the LitMan cache if the YAML file has changed (always, with --no_cache).")
+    cache_parser.set_defaults(handler=lambda litman, config: litman.Cache(litman.LoadDB(config)) if config.no_cache else litman.LoadDB(config))
 
     # Backup
     backup_parser = subparser.add_parser("backup", help="Backup the LitMan database.")
+    backup_parser.set_defaults(handler=lambda litman, config: litman.Backup())
 
     # Add
     add_parser = subparser.add_parser("add", help="Add reference to LitMan.")
-    add_parser.add_argument("--keep_original_file", action='store_true',
-                            help="Do not remove the original file after importing to LitMan.")
-    add_subparser = add_parser.add_subparsers(title="literature type", dest="type")
-    add_subparser.required = True
-
-    ref_parsers = {}
-    for ref_type in reference_types:
-        ref_parsers[ref_type] = add_subparser.add_parser(ref_type,
-                                                         help="Add {}-type reference.".format(ref_type))
-        ref_object = reference_types[ref_type]
-        for var in sorted(vars(ref_object)):
-            if type(vars(ref_object)[var]) == bool:
-                ref_parsers[ref_type] .add_argument("--{}".format(var),
-                                                    action='store_true')
-            else:
-                this_type = type(vars(ref_object)[var][0]) if type(vars(ref_object)[var]) == list else type(var)
-                this_nargs = '+' if type(vars(ref_object)[var])==list else None
-                ref_parsers[ref_type] .add_argument("--{}".format(var),
-                                                    required=True,
-                                                    type=this_type,
-                                                    nargs=this_nargs)
+    add_parser.set_defaults(handler=LitMan.Add)
+    if command in (None, "add"):
+        add_parser.add_argument("--keep_original_file", action='store_true',
+                                help="Do not remove the original file after importing to LitMan.")
+        add_subparser = add_parser.add_subparsers(title="literature type", dest="type")
+        add_subparser.required = True
+
+        ref_parsers = {}
+        for ref_type in reference_types:
+            ref_parsers[ref_type] = add_subparser.add_parser(ref_type,
+                                                             help="Add {}-type reference.".format(ref_type))
+            for var, this_type, this_nargs in reference_types[ref_type].FieldSpec():
+                if this_type == bool:
+                    ref_parsers[ref_type] .add_argument("--{}".format(var),
+                                                        action='store_true')
+                else:
+                    ref_parsers[ref_type] .add_argument("--{}".format(var),
+                                                        required=True,
+                                                        type=this_type,
+                                                        nargs=this_nargs)
 
     # Remove
     remove_parser = subparser.add_parser("remove", help="Remove reference.")
-    remove_parser.add_argument("--ref", type=str, required=True,
-                               help="LitMan reference.")
-    remove_parser.add_argument("--delete_file", action='store_true',
-                               help="Permanently delete file instead of moving to archive.")
+    remove_parser.set_defaults(handler=LitMan.Remove)
+    if command in (None, "remove"):
+        remove_parser.add_argument("--ref", type=str, required=True,
+                                   help="LitMan reference.")
+        remove_parser.add_argument("--delete_file", action='store_true',
+                                   help="Permanently delete file instead of moving to archive.")
 
     # Edit
     edit_parser = subparser.add_parser("edit", help="Edit existing reference.")
-    edit_parser.add_argument("--ref", type=str, required=True,
-                             help="LitMan reference.")
-    edit_parser.add_argument("--add_tag", type=str,
-                             help="Add tag to reference.")
-    edit_parser.add_argument("--rm_tag", type=str,
-                             help="Remove tag from reference.")
-    edit_parser.add_argument("--rm_note", type=int,
-                             help="Remove note (by note index, starting from 0) from reference.")
-    edit_parser.add_argument("--rm_ref", type=int,
-                             help="Remove reference (by index, starting from 0) from reference.")
-    edit_parser.add_argument("--rm_cite", type=int,
-                             help="Remove citation (by index, starting from 0) from reference.")
+    edit_parser.set_defaults(handler=LitMan.Edit)
+    if command in (None, "edit"):
+        edit_parser.add_argument("--ref", type=str, required=True,
+                                 help="LitMan reference.")
+        edit_parser.add_argument("--add_tag", type=str,
+                                 help="Add tag to reference.")
+        edit_parser.add_argument("--rm_tag", type=str,
+                                 help="Remove tag from reference.")
+        edit_parser.add_argument("--rm_note", type=int,
+                                 help="Remove note (by note index, starting from 0) from reference.")
+        edit_parser.add_argument("--rm_ref", type=int,
+                                 help="Remove reference (by index, starting from 0) from reference.")
+        edit_parser.add_argument("--rm_cite", type=int,
+                                 help="Remove citation (by index, starting from 0) from reference.")
 
     # Mark
     mark_parser = subparser.add_parser("mark", help="Mark reference with label.")
-    mark_parser.add_argument("--ref", type=str, required=True,
-                             help="Reference in LitMan to mark.")
-    mark_parser.add_argument("--important", action='store_true',
-                             help="Mark reference as important.")
-    mark_parser.add_argument("--printed", action='store_true',
-                             help="Add note to the reference that it has been printed.")
-    mark_parser.add_argument("--to_read", action='store_true',
-                             help="Mark reference as to-read.")
-    mark_parser.add_argument("--read", action='store_true',
-                             help="Mark reference as read.")
+    mark_parser.set_defaults(handler=LitMan.Mark)
+    if command in (None, "mark"):
+        mark_parser.add_argument("--ref", type=str, required=True,
+                                 help="Reference in LitMan to mark.")
+        mark_parser.add_argument("--important", action='store_true',
+                                 help="Mark reference as important.")
+        mark_parser.add_argument("--printed", action='store_true',
+                                 help="Add note to the reference that it has been printed.")
+        mark_parser.add_argument("--to_read", action='store_true',
+                                 help="Mark reference as to-read.")
+        mark_parser.add_argument("--read", action='store_true',
+                                 help="Mark reference as read.")
 
     # Link
     link_parser = subparser.add_parser("link", help="Link references.")
-    link_parser.add_argument("--ref", type=str, required=True,
-                             help="Reference in LitMan to add link to.")
-    link_parser.add_argument("--cite", type=str, required=True,
-                             help="Literature cited by this reference.")
+    link_parser.set_defaults(handler=LitMan.Link)
+    if command in (None, "link"):
+        link_parser.add_argument("--ref", type=str, required=True,
+                                 help="Reference in LitMan to add link to.")
+        link_parser.add_argument("--cite", type=str, required=True,
+                                 help="Literature cited by this reference.")
+
+    # Add several
+    add_batch_parser = subparser.add_parser("add-batch", help="Add several references to LitMan at once.")
+    add_batch_parser.set_defaults(handler=LitMan.AddBatch)
+    if command in (None, "add-batch"):
+        add_batch_parser.add_argument("--file", type=str, required=True,
+                                      help="YAML file with a list of references, each giving the type and the fields for add (\"-\" for standard input).")
+        add_batch_parser.add_argument("--keep_original_file", action='store_true',
+                                      help="Do not remove the original files after importing to LitMan.")
+
+    # Batch
+    batch_parser = subparser.add_parser("batch", help="Apply several edit/link/mark/note operations at once.")
+    batch_parser.set_defaults(handler=LitMan.Batch)
+    if command in (None, "batch"):
+        batch_parser.add_argument("--file", type=str, required=True,
+                                  help="YAML file with a list of operations, each giving the command and its options (\"-\" for standard input, except for edits removing tags, notes or links).")
+
+    # Sync
+    sync_parser = subparser.add_parser("sync", help="Write the YAML database from the cache (folding in the journal of recent changes).")
+    sync_parser.set_defaults(handler=LitMan.Sync)
 
     # Summary
     summary_parser = subparser.add_parser("summary", help="Summarize references in LitMan.")
+    summary_parser.set_defaults(handler=LitMan.Summary)
 
     # List
     list_parser = subparser.add_parser("list", help="List references in LitMan.")
-    list_parser.add_argument("--search", type=str, nargs='+',
-                             help="Search terms.")
-    list_parser.add_argument("--ref", type=str, nargs='+',
-                             help="LitMan reference.")
-    list_parser.add_argument("--category", type=str, nargs='+',
-                             help="Categories to filter.")
-    list_parser.add_argument("--authors", type=str, nargs='+',
-                             help="Authors to filter.")
-    list_parser.add_argument("--important", action='store_true',
-                             help="List only references marked as important.")
-    list_parser.add_argument("--to_read", action='store_true',
-                             help="List only references marked as to-read.")
-    list_parser.add_argument("--read", action='store_true',
-                             help="List only references marked as read.")
-    list_parser.add_argument("--compact", action='store_true',
-                             help="Print items in a compact view.")
-    list_parser.add_argument("--clipboard", action='store_true',
-                             help="Copy label of top hit to clipboard.")
+    list_parser.set_defaults(handler=LitMan.List)
+    if command in (None, "list"):
+        list_parser.add_argument("--search", type=str, nargs='+',
+                                 help="Search terms.")
+        list_parser.add_argument("--ref", type=str, nargs='+',
+                                 help="LitMan reference.")
+        list_parser.add_argument("--category", type=str, nargs='+',
+                                 help="Categories to filter (entries in any of them are listed).")
+        list_parser.add_argument("--authors", type=str, nargs='+',
+                                 help="Authors to filter.")
+        list_parser.add_argument("--important", action='store_true',
+                                 help="List only references marked as important.")
+        list_parser.add_argument("--to_read", action='store_true',
+                                 help="List only references marked as to-read.")
+        list_parser.add_argument("--read", action='store_true',
+                                 help="List only references marked as read.")
+        list_parser.add_argument("--compact", action='store_true',
+                                 help="Print items in a compact view.")
+        list_parser.add_argument("--clipboard", action='store_true',
+                                 help="Copy label of top hit to clipboard.")
 
     # Open
     open_parser = subparser.add_parser("open", help="Open file for reference in LitMan.")
-    open_parser.add_argument("--search", type=str, nargs='+',
-                             help="Search terms.")
-    open_parser.add_argument("--ref", type=str, nargs='+',
-                             help="LitMan reference.")
-    open_parser.add_argument("--all", action='store_true',
-                             help="Open all matching entries.")
+    open_parser.set_defaults(handler=LitMan.Open)
+    if command in (None, "open"):
+        open_parser.add_argument("--search", type=str, nargs='+',
+                                 help="Search terms.")
+        open_parser.add_argument("--ref", type=str, nargs='+',
+                                 help="LitMan reference.")
+        open_parser.add_argument("--all", action='store_true',
+                                 help="Open all matching entries.")
 
     # Note
     note_parser = subparser.add_parser("note", help="Add note to existing reference.")
-    note_parser.add_argument("--ref", type=str, required=True,
-                             help="LitMan reference.")
-    note_parser.add_argument("--note", type=str, required=True, action='append',
-                             help="Add note to reference; multiple entries can be made in bullet-point style.")
+    note_parser.set_defaults(handler=LitMan.Note)
+    if command in (None, "note"):
+        note_parser.add_argument("--ref", type=str, required=True,
+                                 help="LitMan reference.")
+        note_parser.add_argument("--note", type=str, required=True, action='append',
+                                 help="Add note to reference; multiple entries can be made in bullet-point style.")
 
     # Search
     search_parser = subparser.add_parser("search", help="Search the database.")
-    search_parser.add_argument("keyword", type=str, nargs='*',
-                               help="Keywords to search.")
-    search_parser.add_argument("--important", action='store_true',
-                               help="List only references marked as important.")
-    search_parser.add_argument("--to_read", action='store_true',
-                               help="List only references marked as to-read.")
-    search_parser.add_argument("--read", action='store_true',
-                               help="List only references marked as read.")
-    search_parser.add_argument("--compact", action='store_true',
-                               help="Print items in a compact view.")
-    search_parser.add_argument("--clipboard", action='store_true',
-                               help="Copy label of top hit to clipboard.")
-
+    search_parser.set_defaults(handler=LitMan.Search)
+    if command in (None, "search"):
+        search_parser.add_argument("keyword", type=str, nargs='*',
+                                   help="Keywords to search.")
+        search_parser.add_argument("--important", action='store_true',
+                                   help="List only references marked as important.")
+        search_parser.add_argument("--to_read", action='store_true',
+                                   help="List only references marked as to-read.")
+        search_parser.add_argument("--read", action='store_true',
+                                   help="List only references marked as read.")
+        search_parser.add_argument("--compact", action='store_true',
+                                   help="Print items in a compact view.")
+        search_parser.add_argument("--clipboard", action='store_true',
+                                   help="Copy label of top hit to clipboard.")
 
     # Print
     print_parser = subparser.add_parser("print", help="Print a reference.")
-    print_parser.add_argument("--ref", type=str, required=True,
-                              help="LitMan reference.")
-    print_parser.add_argument("--printer", type=str, default="nml2-hp479",
-                              help="Printer name [default: \"nml2-hp479\" (NML South)].")
-    print_parser.add_argument("--page_size", type=str, default="letter",
-                              help="Page size to use [default: \"letter\"].")
-    print_parser.add_argument("--single_sided", action='store_true',
-                              help="Print single-sided [default: off; double-sided].")
-    print_parser.add_argument("--printer_slot", type=str, default='Tray3',
-                              help="Printer slot to use [default: Tray3].")
-    print_parser.add_argument("--print_options", type=str, default="",
-                              help="Further print options.")
+    print_parser.set_defaults(handler=LitMan.Print)
+    if command in (None, "print"):
+        print_parser.add_argument("--ref", type=str, required=True,
+                                  help="LitMan reference.")
+        print_parser.add_argument("--printer", type=str, default="nml2-hp479",
+                                  help="Printer name [default: \"nml2-hp479\" (NML South)].")
+        print_parser.add_argument("--page_size", type=str, default="letter",
+                                  help="Page size to use [default: \"letter\"].")
+        print_parser.add_argument("--single_sided", action='store_true',
+                                  help="Print single-sided [default: off; double-sided].")
+        print_parser.add_argument("--printer_slot", type=str, default='Tray3',
+                                  help="Printer slot to use [default: Tray3].")
+        print_parser.add_argument("--print_options", type=str, default="",
+                                  help="Further print options.")
 
     return parser.parse_args()
 
+def ReadConfig():
+
+    # The file written by setup only holds plain absolute paths, which
+    # are read directly; anything else is handed to the YAML parser
+    with open(litman_config_path, 'r') as litman_config_file:
+        contents = litman_config_file.read()
+    litman_config = {}
+    for line in contents.splitlines():
+        key, sep, value = line.partition(': ')
+        if not sep or not key.isidentifier() or not value.startswith('/') or ' #' in value or ': ' in value:
+            return LoadYAML(contents)
+        litman_config[key] = value
+    return litman_config if litman_config else None
+
 def SetupLitManEnv(config):
 
     # Ensure a configuration file
-    litman_config_file = "{}/.litman".format(os.path.expanduser("~"))
-    if not os.path.exists(litman_config_file):
-        print("\nLitMan configuration file not found; making new file {}... ".format(litman_config_file), end='')
-        with open(litman_config_file, 'a'):
-            os.utime(litman_config_file, None)
+    if not os.path.exists(litman_config_path):
+        print("\nLitMan configuration file not found; making new file {}... ".format(litman_config_path), end='')
+        open(litman_config_path, 'a').close()
         print("\033[32mDone.\033[0m\n")
     else:
-        Confirm("Overwrite existing configuration file {}?".format(litman_config_file))
+        Confirm("Overwrite existing configuration file {}?".format(litman_config_path))
 
     # Save configuration
     configuration = {'directory':os.path.abspath(config.litman_dir),
                      'backup':os.path.abspath(config.backup_dir)}
-    with open(litman_config_file, 'w') as config_file:
-        yaml.dump(configuration, config_file)
+    with open(litman_config_path, 'w') as config_file:
+        DumpYAML(configuration, config_file)
 
 def main():
 
@@ -758,16 +1308,16 @@ def main():
     if config.command == 'setup':
         SetupLitManEnv(config)
         exit()
-
-    # Check configuration file
-    litman_config_file = "{}/.litman".format(os.path.expanduser("~"))
-    if not os.path.exists(litman_config_file):
-        print("\nLitMan configuration file not found; use \033[1mlitman setup\033[0m to configure LitMan.\n")
+    if config.command == 'config':
+        print("Config not yet implemented.")
         exit()
 
     # Read litman configuration file
-    with open("{}/.litman".format(os.path.expanduser("~")), 'r') as litman_config_file:
-        litman_config = yaml.safe_load(litman_config_file)
+    try:
+        litman_config = ReadConfig()
+    except FileNotFoundError:
+        print("\nLitMan configuration file not found; use \033[1mlitman setup\033[0m to configure LitMan.\n")
+        exit()
     if litman_config is None:
         raise RuntimeError("\033[31m\nLitMan configuration file is empty; use \033[1mlitman setup\033[31m to configure.\033[0m\n")
 
@@ -775,36 +1325,7 @@ def main():
     litman = LitMan(litman_config)
 
     # Do stuff
-    match config.command:
-        case "config":
-            print("Config not yet implemented.")
-            exit()
-        case "cache":
-            litman.Cache()
-        case "backup":
-            litman.Backup()
-        case "add":
-            litman.Add(config)
-        case "edit":
-            litman.Edit(config)
-        case "remove":
-            litman.Remove(config)
-        case "mark":
-            litman.Mark(config)
-        case "link":
-            litman.Link(config)
-        case "summary":
-            litman.Summary(config)
-        case "list":
-            litman.List(config)
-        case "open":
-            litman.Open(config)
-        case "note":
-            litman.Note(config)
-        case "search":
-            litman.Search(config)
-        case "print":
-            litman.Print(config)
+    config.handler(litman, config)
 
 if __name__ == "__main__":
     main()